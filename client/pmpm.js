@@ -77,31 +77,60 @@ let tocTitleText;
 let tocUpdated = false;
 let tocContentVisible = false;
 
+// Outline index sent by the server, see outlineindex in websocket.py
+// Entries are [level, id, position of the block minus that of the previous entry]
+let outline = [];
+let outlineId = null;
+
+function applyOutlineDiff(diff)
+{
+    if(diff.base !== outlineId) {
+        // We missed an update (or just connected), ask for the full outline
+        getWebsocket().then((websocket) => websocket.send('outline'));
+        return;
+    }
+    outline.splice(diff.start, diff.delete, ...diff.insert);
+    outlineId = diff.id;
+}
+
+function outlineEvent(fullOutline, id)
+{
+    outline = fullOutline;
+    outlineId = id;
+    if(tocEnabled && tocContentVisible)
+        updateToc();
+    else
+        tocUpdated = false;
+}
+
+function* outlineHeadings()
+{
+    let pos = 0;
+    for(const [hLevel, id, dpos] of outline) {
+        pos += dpos;
+        const block = children[pos];
+        if(!block)
+            return;
+        const h = id ? block.querySelector(`[id="${CSS.escape(id)}"]`) : block.querySelector('h'+hLevel);
+        if(h)
+            yield [hLevel, h];
+    }
+    // Don't show the References header if the references are hidden
+    // (either because no references exist or because a custom div is in the text)
+    if(references.style.display !== 'none' && referencesTitle.style.display !== 'none')
+        yield [1, referencesTitle];
+}
+
 function updateToc()
 {
     // Remove current content
     tocContent.textContent = '';
 
-    // Build toc based on headings
-    // Use container.parentNode because this also includes references
-    // Like pandoc's default 'toc-depth: 3'. Not configurable at the moment since
-    // pandoc doesn't parse 'toc-depth' from YAML metadata block
-    const hs = container.parentNode.querySelectorAll('h1, h2, h3');
+    // Build toc based on the outline index instead of querying the whole document
     const uls = [tocContent];
     tocContent._pmpmLastHlevel = 1;
     let lastLi = undefined;
-    for(const h of hs) {
-
-        const hLevel = parseInt(h.nodeName[1]);
-        if(hLevel == 1) {
-            // Don't show the "Title" in the <header>
-            if(h.classList.contains('title') && h.parentNode.nodeName == 'HEADER')
-                continue;
-            // Don't show the References header if the references are hidden
-            // (either because no references exist or because a custom div is in the text)
-            if(h.id === 'bibliography' && references.style.display === 'none')
-                continue;
-        }
+    for(const [hLevel, h] of outlineHeadings()) {
 
         const lastHLevel = uls[uls.length-1]._pmpmLastHlevel;
 
@@ -325,6 +354,14 @@ function localLinkClickEvent(el)
     return false;
 }
 
+// Open the full resolution of an image that is shown downscaled
+// called for local images with --image-width, see websocket.py
+function imageClickEvent(el)
+{
+    window.open(el.dataset.full);
+    return false;
+}
+
 function nodeLinkClickEvent(event)
 {
     let a = event.target;
@@ -467,14 +504,19 @@ function updateRefsFromCiteprocResult()
     // Save bibid of bibid that is used now
     citeprocBibid = _lastCiteprocBibid;
 
-    // parse the HTML in a temporary container
-    const div = document.createElement('div');
-    div.innerHTML = _lastCiteprocHtml;
+    // Either the formatted citations (the reference list is sent along only if it changed),
+    // or the full HTML of a citeproc run, parsed in a temporary container
+    let citeprocCitations = _lastCiteprocCitations;
+    let div;
+    if(citeprocCitations === undefined) {
+        div = document.createElement('div');
+        div.innerHTML = _lastCiteprocHtml;
+        citeprocCitations = div.getElementsByClassName('citation');
+    }
 
     // Update textcites
     let i = 0;
     const updatedTextcites = {};
-    const citeprocCitations = div.getElementsByClassName('citation');
     for(const block of children) {
         const referenceElements = block._referenceElements;
         if(referenceElements === undefined)
@@ -490,20 +532,20 @@ function updateRefsFromCiteprocResult()
             const citeprocCitation = citeprocCitations[i-1];
             const textciteCache = _textcitesCache[textcite];
 
-            // For pandoc version < 2.11:
-            // Not-found citations are displayed as "???" by default, replace with citekey
-            // Must be done before html compare
-            // For pandoc version >= 2.11:
-            // This doesn't work because not-found citations don't have "citeproc-not-found" class.
-            // But: Not-found citations already contain the citekey anyway.
-            // Note: For pandoc version >= 2.11 the following for loop is redundant,
-            // yet should have no noticeable effect on performance;
-            // if performance should be a problem in the future: have the server send along
-            // a flag indicating whether the client is required to replace  not-found citation keys
-            for(const missing of citeprocCitation.getElementsByClassName('citeproc-not-found'))
-                missing.textContent = missing.getAttribute('data-reference-id');
-
-            const html = citeprocCitation.innerHTML;
+            let html = citeprocCitation;
+            if(div !== undefined) {
+                // For pandoc version < 2.11:
+                // Not-found citations are displayed as "???" by default, replace with citekey
+                // Must be done before html compare
+                // (the server already does this for formatted citations)
+                // For pandoc version >= 2.11:
+                // This doesn't work because not-found citations don't have "citeproc-not-found" class.
+                // But: Not-found citations already contain the citekey anyway.
+                for(const missing of citeprocCitation.getElementsByClassName('citeproc-not-found'))
+                    missing.textContent = missing.getAttribute('data-reference-id');
+                html = citeprocCitation.innerHTML;
+            }
+
             if(textciteCache.html == html)
                 continue;
             textciteCache.html = html;
@@ -515,6 +557,30 @@ function updateRefsFromCiteprocResult()
         }
     }
 
+    if(div !== undefined) {
+        _appliedRefsId = undefined;
+        updateRefList(div);
+    } else
+        updateRefsFromRefsResult();
+
+    // Signal that rendering is finished
+    if(_citeprocDoneResolve)
+        _citeprocDoneResolve();
+}
+
+function updateRefsFromRefsResult()
+{
+    // The reference list is only re-parsed if it changed
+    if(_lastRefsId === undefined || _lastRefsId === _appliedRefsId)
+        return;
+    _appliedRefsId = _lastRefsId;
+    const div = document.createElement('div');
+    div.innerHTML = _lastRefsHtml;
+    updateRefList(div);
+}
+
+function updateRefList(div)
+{
     // Replace reference list with new reference list, if any
     const refList = div.querySelector('.references');
     if(refList) {
@@ -522,23 +588,52 @@ function updateRefsFromCiteprocResult()
         replaceRefList(refList);
         showHideRefList();
     }
-
-    // Signal that rendering is finished
-    if(_citeprocDoneResolve)
-        _citeprocDoneResolve();
 }
 
 let _lastCiteprocHtml;
+let _lastCiteprocCitations;
 let _lastCiteprocBibid;
-function citeprocResultEvent(html, bibid)
+// Id of _lastCiteprocCitations, the diffs of citeproc in websocket.py apply to it
+let _citationsId = null;
+let _lastRefsHtml;
+let _lastRefsId;
+let _appliedRefsId;
+function citeprocResultEvent(message)
 {
-    if(bibid == _lastCiteprocBibid) {
+    if(message.bibid == _lastCiteprocBibid) {
         // We already have this
         return;
     }
 
-    _lastCiteprocHtml = html;
-    _lastCiteprocBibid = bibid;
+    let citations;
+    if(message.citations !== undefined) {
+        const diff = message.citations;
+        if(diff.base === null) {
+            citations = [];
+        } else if(diff.base === _citationsId && _lastCiteprocCitations !== undefined) {
+            citations = [..._lastCiteprocCitations];
+        } else {
+            // We missed an update (or just connected), ask for all citations
+            getWebsocket().then((websocket) => websocket.send('citations'));
+            return;
+        }
+        citations.splice(diff.start, diff.delete, ...diff.insert);
+        _citationsId = diff.id;
+    } else {
+        _citationsId = null;
+    }
+
+    _lastCiteprocHtml = message.html;
+    _lastCiteprocCitations = citations;
+    _lastCiteprocBibid = message.bibid;
+
+    if(message.refs !== undefined) {
+        _lastRefsHtml = message.refs;
+        _lastRefsId = message.refsid;
+    } else if(message.refsid !== undefined && message.refsid !== _lastRefsId) {
+        // We missed the reference list (or just connected), ask for it
+        getWebsocket().then((websocket) => websocket.send('refs'));
+    }
 
     if(_lastCiteprocBibid == contentBibid) {
         // Citeproc result is for htmlblocks that we have already loaded
@@ -549,6 +644,14 @@ function citeprocResultEvent(html, bibid)
     }
 }
 
+function refsEvent(refs, refsid)
+{
+    _lastRefsHtml = refs;
+    _lastRefsId = refsid;
+    if(_lastCiteprocCitations !== undefined && citeprocBibid == _lastCiteprocBibid)
+        updateRefsFromRefsResult();
+}
+
 const _textcitesCache = {};
 let _refsElement;
 let _citeprocDoneResolve;
@@ -786,6 +889,7 @@ async function initWebsocket()
         if(message.htmlblocks !== undefined) {
             // update page
             tocEnabled = message.toc;
+            applyOutlineDiff(message.outline);
             tocTitleText = message["toc-title"] ?? tocTitleTextDefault;
             contentBibid = message.bibid;
             suppressBibliography = message["suppress-bibliography"];
@@ -793,7 +897,17 @@ async function initWebsocket()
         } else {
             if(message.bibid !== undefined) {
                 // Async citeproc result
-                citeprocResultEvent(message.html, message.bibid);
+                citeprocResultEvent(message);
+                return;
+            }
+            if(message.refs !== undefined) {
+                // Reference list, requested by citeprocResultEvent
+                refsEvent(message.refs, message.refsid);
+                return;
+            }
+            if(message["outline-full"] !== undefined) {
+                // Full outline, requested by applyOutlineDiff
+                outlineEvent(message["outline-full"], message["outline-id"]);
                 return;
             }
             if(message.error !== undefined) {
@@ -0,0 +1,91 @@
+"""
+Helpers for incremental citeproc, see citeproc_clusters in websocket.py
+incrementalstyle:
+    whether citations of a csl style can be formatted independently of their
+    position, i.e. no citation numbers and no ibid/subsequent forms
+clusterkey:
+    a citation cluster without its position in the document
+keycluster:
+    a synthetic cluster citing only one key, used to detect whether
+    disambiguation changed the citations of already formatted keys
+parsecitations:
+    splits citeproc html into the formatted clusters and the bibliography
+"""
+
+
+from functools import lru_cache
+import json
+import re
+
+
+citationRegex = re.compile(
+    '<p><span class="citation"[^>]*>(.*?)</span></p>', re.DOTALL)
+# For pandoc version < 2.11:
+# Not-found citations are displayed as "???" by default, replace with citekey
+notFoundRegex = re.compile(
+    '(<span class="citeproc-not-found" data-reference-id="([^"]*)">)'
+    '[^<]*(</span>)')
+
+
+@lru_cache(maxsize=16)
+def incrementalstyle(cslpath, mtime):
+    try:
+        with cslpath.open('r') as f:
+            csl = f.read()
+    except OSError:
+        return False
+    return not ('citation-number' in csl
+                or 'position=' in csl
+                or 'class="note"' in csl)
+
+
+def clusterkey(block):
+    """ json of a citeblock with citationNoteNum and citationHash zeroed
+
+    These count the notes and citations before the cluster, so the same
+    citation would never hit a cache after any citation is added above it.
+    """
+    cite = block['c'][0]
+    citations = [dict(c, citationNoteNum=0, citationHash=0)
+                 for c in cite['c'][0]]
+    return json.dumps({"t": "Para",
+                       "c": [{"t": "Cite", "c": [citations, cite['c'][1]]}]})
+
+
+def clusterkeys(block):
+    return [c['citationId'] for c in block['c'][0]['c'][0]]
+
+
+def keycluster(key):
+    return {"t": "Para",
+            "c": [{"t": "Cite",
+                   "c": [[{"citationId": key,
+                           "citationPrefix": [],
+                           "citationSuffix": [],
+                           "citationMode": {"t": "NormalCitation"},
+                           "citationNoteNum": 0,
+                           "citationHash": 0}],
+                         [{"t": "Str", "c": f"[@{key}]"}]]}]}
+
+
+def parsecitations(html, n):
+    """ split citeproc output for n citeblocks
+
+    Returns:
+        citations: list: inner html of the n formatted clusters, in order
+        refs: str: the html of the bibliography
+        entries: dict: citekey -> html of its bibliography entry
+        or None, if html does not consist of n clusters and a bibliography
+    """
+    citations = [notFoundRegex.sub('\\1\\2\\3', m.group(1))
+                 for m in citationRegex.finditer(html)]
+    if len(citations) != n:
+        return None
+    start = html.find('<div id="refs"')
+    refs = html[start:] if start != -1 else ''
+    entries = {}
+    # without the closing tag of the bibliography, so that the last entry
+    # compares equal to the same entry in the middle of another bibliography
+    for chunk in refs[:refs.rfind('</div>')].split('<div id="ref-')[1:]:
+        entries[chunk[:chunk.find('"')]] = chunk
+    return citations, refs, entries
@@ -0,0 +1,147 @@
+"""
+A stand-in for pandoc, good enough to drive pmpm-websocket offline, e.g.
+from pmpm-loadtest. It understands exactly the calls in PANDOC_CALLS:
+    --to json:
+        every paragraph becomes a Para, lines starting with # a Header,
+        [@key; @key2] a Cite, and a first paragraph between --- lines of
+        "key: value" lines the metadata
+    --from json --standalone:
+        the title block
+    --from json:
+        every block becomes a <p> or <hN>
+    --citeproc / --filter pandoc-citeproc:
+        every citation becomes a <span class="citation">
+The environment variable PMPM_FAKEPANDOC_DELAY sets the seconds every call
+sleeps to mimic the cost of real pandoc.
+"""
+
+
+import html
+from itertools import count
+import json
+import os
+import re
+import sys
+import time
+
+
+citeRegex = re.compile('\\[(@[^\\]]*)\\]')
+
+
+def inlines2text(inlines):
+    return ''.join(i['c'] if i['t'] == 'Str'
+                   else inlines2text(i['c'][1]) if i['t'] == 'Cite'
+                   else ' ' for i in inlines)
+
+
+def para2inlines(para, hashes):
+    inlines = []
+    pos = 0
+    for m in citeRegex.finditer(para):
+        if m.start() > pos:
+            inlines.append({"t": "Str", "c": para[pos:m.start()]})
+        citations = [{"citationId": key.strip().lstrip('@'),
+                      "citationPrefix": [],
+                      "citationSuffix": [],
+                      "citationMode": {"t": "NormalCitation"},
+                      "citationNoteNum": 0,
+                      "citationHash": next(hashes)}
+                     for key in m.group(1).split(';')]
+        inlines.append({"t": "Cite",
+                        "c": [citations, [{"t": "Str", "c": m.group(0)}]]})
+        pos = m.end()
+    if pos < len(para):
+        inlines.append({"t": "Str", "c": para[pos:]})
+    return inlines
+
+
+def md2json(content):
+    blocks = []
+    meta = {}
+    hashes = count(1)
+    paras = content.split('\n\n')
+    if paras[0].startswith('---\n') and paras[0].endswith('\n---'):
+        for line in paras.pop(0).split('\n')[1:-1]:
+            key, _, value = line.partition(':')
+            meta[key.strip()] = {"t": "MetaInlines",
+                                 "c": [{"t": "Str", "c": value.strip()}]}
+    for para in paras:
+        para = para.strip()
+        if not para:
+            continue
+        if para.startswith('#'):
+            level = len(para) - len(para.lstrip('#'))
+            text = para[level:].strip()
+            blocks.append({"t": "Header",
+                           "c": [level,
+                                 [text.lower().replace(' ', '-'), [], []],
+                                 [{"t": "Str", "c": text}]]})
+        else:
+            blocks.append({"t": "Para", "c": para2inlines(para, hashes)})
+    return json.dumps({"pandoc-api-version": [1, 22],
+                       "meta": meta,
+                       "blocks": blocks})
+
+
+def block2html(block):
+    if block['t'] == 'Header':
+        level, (ident, _, _), inlines = block['c']
+        return (f'<h{level} id="{ident}">'
+                f'{html.escape(inlines2text(inlines))}</h{level}>')
+    if block['t'] == 'Para':
+        return f'<p>{html.escape(inlines2text(block["c"]))}</p>'
+    return ''
+
+
+def json2html(content, standalone):
+    doc = json.loads(content)
+    if standalone:
+        # like pandoc, a whole page with a title block only if there is a title
+        title = doc['meta'].get('title')
+        header = ''
+        if title is not None:
+            header = ('<header id="title-block-header">\n<h1 class="title">'
+                      f'{html.escape(inlines2text(title["c"]))}</h1>\n'
+                      '</header>\n')
+        return ('<!DOCTYPE html>\n<html>\n<head>\n</head>\n<body>\n'
+                f'{header}</body>\n</html>')
+    return '\n'.join(block2html(b) for b in doc['blocks'])
+
+
+def citeproc(content):
+    doc = json.loads(content)
+    out = []
+    keys = set()
+    for block in doc['blocks']:
+        for cite in block['c']:
+            ids = [c['citationId'] for c in cite['c'][0]]
+            keys.update(ids)
+            out.append('<p><span class="citation" '
+                       f'data-cites="{" ".join(ids)}">'
+                       f'({"; ".join(ids)})</span></p>')
+    out.append('<div id="refs" class="references csl-bib-body" '
+               'role="doc-bibliography">')
+    out.extend(f'<div id="ref-{k}" class="csl-entry" role="doc-biblioentry">'
+               f'{k}</div>' for k in sorted(keys))
+    out.append('</div>')
+    return '\n'.join(out)
+
+
+def main():
+    args = sys.argv[1:]
+    content = sys.stdin.read()
+    time.sleep(float(os.environ.get("PMPM_FAKEPANDOC_DELAY", 0)))
+    if '--to' in args and args[args.index('--to') + 1] == 'json':
+        out = md2json(content)
+    elif '--citeproc' in args or '--filter' in args:
+        out = citeproc(content) if content else ''
+    elif content:
+        out = json2html(content, '--standalone' in args)
+    else:
+        out = ''
+    sys.stdout.write(out + '\n')
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
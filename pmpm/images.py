@@ -0,0 +1,91 @@
+"""
+downscaleimage:
+    downscaled variants of local images, served by pmpm-websocket under
+    /image?path=...&width=... if Pillow is installed, and cached on disk by
+    (path, mtime, width) in $XDG_CACHE_HOME/pmpm/images
+evictcache:
+    keeps the cache below MAX_CACHE_BYTES, least recently served first
+"""
+
+
+import hashlib
+import mimetypes
+import os
+from pathlib import Path
+import tempfile
+
+try:
+    from PIL import Image, ImageOps
+except ModuleNotFoundError:
+    Image = None
+
+
+# Formats that Pillow can downscale without losing anything but pixels, i.e.
+# no vector graphics and no animations
+IMAGE_SUFFIXES = {'.bmp', '.jpeg', '.jpg', '.png', '.tif', '.tiff', '.webp'}
+MAX_IMAGE_WIDTH = 4096
+MAX_CACHE_BYTES = 256 * 2**20
+
+CACHE_DIR = Path(os.environ.get("XDG_CACHE_HOME", "~/.cache")
+                 ).expanduser() / "pmpm" / "images"
+
+
+def imagekey(fpath, mtime, width):
+    return hashlib.sha1(f"{fpath}:{mtime}:{width}".encode()).hexdigest()
+
+
+def downscaleimage(fpath, mtime, width):
+    """ the image at fpath, downscaled to at most width pixels wide
+
+    Args:
+        fpath: Path: absolute path of the image
+        mtime: float: mtime of the image, part of the cache key
+        width: int: the maximum width
+
+    Returns:
+        data: bytes: the (possibly downscaled) image
+        content_type: str: its mime type
+    """
+    content_type = mimetypes.guess_type(fpath.name)[0]
+    cached = CACHE_DIR / (imagekey(fpath, mtime, width) + fpath.suffix)
+    if cached.is_file():
+        # mark as recently served for evictcache
+        os.utime(cached)
+        return cached.read_bytes(), content_type
+
+    with Image.open(fpath) as img:
+        imgformat = img.format
+        # the saved variant has no exif, so apply its orientation to the
+        # pixels, just like browsers display the original
+        img = ImageOps.exif_transpose(img)
+        if img.width <= width:
+            return fpath.read_bytes(), content_type
+        img.thumbnail((width, img.height * width // img.width + 1))
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        # write to a temporary file first, the same image may be requested
+        # by several clients at once
+        with tempfile.NamedTemporaryFile(dir=CACHE_DIR, delete=False) as f:
+            img.save(f, format=imgformat, quality=85)
+    os.replace(f.name, cached)
+    data = cached.read_bytes()
+    evictcache()
+    return data, content_type
+
+
+def evictcache():
+    files = []
+    for entry in os.scandir(CACHE_DIR):
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= MAX_CACHE_BYTES:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
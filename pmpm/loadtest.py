@@ -0,0 +1,347 @@
+"""
+pmpm-loadtest: load generator for pmpm-websocket
+
+run_loadtest():
+    entry point, starts a pmpm-websocket in a temporary XDG_RUNTIME_DIR and
+    home, and optionally pmpm-workers for it,
+    with pmpm.fakepandoc as pandoc so that it runs offline
+--> client:
+    one simulated browser tab, records when it receives which write
+--> writer:
+    replays an editor-like write stream into the named pipe, i.e. every write
+    changes one block of the document and carries a sequence number
+--> sampleserver:
+    samples cpu time and memory of the server (and its pandoc children)
+report:
+    latency from pipe write to client receipt, coalesced updates, cpu, memory
+"""
+
+
+import argparse
+import asyncio
+import os
+from pathlib import Path
+import random
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import websockets
+
+
+SEQ_TAG = 'pmpm-loadtest-seq-'
+seqRegex = re.compile(SEQ_TAG + '([0-9]+)')
+
+BIBFILE = 'loadtest.bib'
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def parse_loadtest_args(args=None) -> argparse.Namespace:
+    """ populate the pmpm-loadtest command line arguments
+
+    Args:
+        args: the arguments to parse
+
+    Returns:
+        parsed_args: the parsed arguments
+
+    """
+    parser = argparse.ArgumentParser(
+        description="pmpm-loadtest: load generator for pmpm-websocket")
+    parser.add_argument(
+        "-p",
+        "--port",
+        default="9878",
+        help="port of the pmpm-websocket under test",
+    )
+    parser.add_argument(
+        "-c",
+        "--clients",
+        type=int,
+        default=10,
+        help="number of simulated websocket clients",
+    )
+    parser.add_argument(
+        "-r",
+        "--rate",
+        type=float,
+        default=5.,
+        help="writes per second into the named pipe",
+    )
+    parser.add_argument(
+        "-d",
+        "--duration",
+        type=float,
+        default=20.,
+        help="seconds to write into the named pipe",
+    )
+    parser.add_argument(
+        "-b",
+        "--blocks",
+        type=int,
+        default=200,
+        help="number of blocks of the generated document",
+    )
+    parser.add_argument(
+        "--citations",
+        type=int,
+        default=0,
+        help=("number of distinct citation keys cited throughout "
+              "the generated document, 0 for no bibliography"),
+    )
+    parser.add_argument(
+        "--document",
+        help=("markdown file to replay edits on "
+              "instead of the generated document"),
+    )
+    parser.add_argument(
+        "--pandoc-delay",
+        type=float,
+        default=.02,
+        help="seconds every fake pandoc call takes in addition to startup",
+    )
+    parser.add_argument(
+        "--real-pandoc",
+        action="store_true",
+        help="use the pandoc on the PATH instead of pmpm.fakepandoc",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=0,
+        help="number of pmpm-worker processes to start and render on",
+    )
+    parser.add_argument(
+        "--server-args",
+        default="",
+        help="additional arguments for pmpm-websocket, e.g. '--max-pandoc 2'",
+    )
+    return parser.parse_args(args=args)
+
+
+def generatedocument(nblocks, ncitations):
+    blocks = []
+    if ncitations:
+        blocks.append(f"---\nbibliography: {BIBFILE}\n---")
+    for k in range(nblocks):
+        if k % 10 == 0:
+            blocks.append(f"# Section {k // 10}")
+        elif ncitations and k % 3 == 0:
+            blocks.append(f"Paragraph {k} [@key{k % ncitations}] "
+                          + "lorem ipsum dolor " * 8)
+        else:
+            blocks.append(f"Paragraph {k} " + "lorem ipsum dolor " * 8)
+    return blocks
+
+
+def procstat(pid):
+    """ cpu seconds of pid and its reaped children, and resident memory
+
+    Returns:
+        cpu: float: user+system seconds, including waited-for children
+        rss: int: resident set size in bytes
+    """
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    # fields[0] is field 3 (state) of proc(5)
+    utime, stime, cutime, cstime = (int(x) for x in fields[11:15])
+    rss = int(fields[21]) * PAGE_SIZE
+    return (utime + stime + cutime + cstime) / CLOCK_TICKS, rss
+
+
+async def sampleserver(pid, samples):
+    while True:
+        try:
+            samples.append((time.monotonic(), *procstat(pid)))
+        except FileNotFoundError:
+            return
+        await asyncio.sleep(.1)
+
+
+async def client(url, received):
+    async with websockets.connect(url, max_size=None) as websocket:
+        async for message in websocket:
+            now = time.monotonic()
+            received['messages'] += 1
+            # citeproc_clusters results start with "citations",
+            # full citeproc_sub results with "html"
+            if message.startswith('{"citations"'):
+                received['citations'] += 1
+            elif message.startswith('{"html"'):
+                received['citeproc'] += 1
+            # only look at the htmlblocks messages, do not parse the json
+            if not message.startswith('{"filepath"'):
+                continue
+            m = seqRegex.search(message)
+            if m is not None:
+                received['seqs'][int(m.group(1))] = now
+
+
+def writepipe(pipe, data):
+    # blocks until pmpm-websocket (re)opened the pipe for reading
+    with open(pipe, 'wb') as f:
+        f.write(data)
+
+
+async def writer(pipe, blocks, first, rate, duration, written):
+    loop = asyncio.get_running_loop()
+    start = time.monotonic()
+    rnd = random.Random(0)
+    for seq in range(int(rate * duration)):
+        await asyncio.sleep(max(0., start + seq / rate - time.monotonic()))
+        # "type" into a random block (not into the metadata before first)
+        # and update the sequence number
+        k = rnd.randrange(first, len(blocks))
+        blocks[k] += rnd.choice(' abcdefghijklmnopqrstuvwxyz')
+        content = ("<!-- filepath:loadtest.md -->\n"
+                   + "\n\n".join(blocks[:first] + [f"{SEQ_TAG}{seq}"]
+                                   + blocks[first:]))
+        written[seq] = time.monotonic()
+        await loop.run_in_executor(None, writepipe, pipe, content.encode())
+
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def report(args, written, receivers, samples, elapsed):
+    print(f"\n{len(written)} writes in {elapsed:.1f}s "
+          f"({len(written) / elapsed:.1f}/s) to {len(receivers)} clients")
+
+    latencies = sorted(t - written[seq]
+                       for r in receivers
+                       for seq, t in r['seqs'].items())
+    if latencies:
+        print("latency pipe write -> client receipt [ms]: "
+              f"mean {1000 * statistics.mean(latencies):.0f}  "
+              f"p50 {1000 * percentile(latencies, .5):.0f}  "
+              f"p90 {1000 * percentile(latencies, .9):.0f}  "
+              f"p99 {1000 * percentile(latencies, .99):.0f}  "
+              f"max {1000 * latencies[-1]:.0f}")
+    else:
+        print("no updates received")
+
+    seen = set().union(*(r['seqs'].keys() for r in receivers))
+    last = max(written) if written else None
+    print(f"updates rendered: {len(seen)}, "
+          f"coalesced: {len(written) - len(seen)}, "
+          f"last write rendered: {last in seen}")
+    missing = [len(seen - r['seqs'].keys()) for r in receivers]
+    print(f"rendered updates not received, per client: "
+          f"max {max(missing, default=0)}, total {sum(missing)}")
+    messages = [r['messages'] for r in receivers]
+    print(f"messages per client (incl. status): "
+          f"mean {statistics.mean(messages) if messages else 0:.0f}")
+    if args.citations and receivers:
+        print("citeproc results per client: "
+              f"incremental {receivers[0]['citations']}, "
+              f"full {receivers[0]['citeproc']}")
+
+    if len(samples) > 1:
+        (t0, cpu0, _), (t1, cpu1, _) = samples[0], samples[-1]
+        print(f"server cpu (incl. pandoc): {cpu1 - cpu0:.1f}s, "
+              f"{100 * (cpu1 - cpu0) / (t1 - t0):.0f}% of one core; "
+              f"rss: peak {max(s[2] for s in samples) / 2**20:.0f}MiB, "
+              f"end {samples[-1][2] / 2**20:.0f}MiB")
+
+
+async def loadtest(args, pipe, server):
+    url = f"ws://127.0.0.1:{args.port}/"
+    # wait for the server to come up
+    for _ in range(100):
+        try:
+            async with websockets.connect(url):
+                break
+        except OSError:
+            await asyncio.sleep(.1)
+    else:
+        raise RuntimeError(f"pmpm-websocket did not start on {url}")
+
+    receivers = [{'messages': 0, 'citations': 0, 'citeproc': 0, 'seqs': {}}
+                 for _ in range(args.clients)]
+    clients = [asyncio.ensure_future(client(url, r)) for r in receivers]
+    samples = []
+    sampler = asyncio.ensure_future(sampleserver(server.pid, samples))
+    await asyncio.sleep(.5)
+
+    first = 0
+    if args.document:
+        blocks = Path(args.document).read_text().split('\n\n')
+    else:
+        blocks = generatedocument(args.blocks, args.citations)
+        first = 1 if args.citations else 0
+    written = {}
+    start = time.monotonic()
+    await writer(pipe, blocks, first, args.rate, args.duration, written)
+    elapsed = time.monotonic() - start
+
+    # give the server time to render and distribute the last write
+    last = max(written, default=None)
+    for _ in range(300):
+        if all(last in r['seqs'] for r in receivers):
+            break
+        await asyncio.sleep(.1)
+
+    for task in clients + [sampler]:
+        task.cancel()
+    report(args, written, receivers, samples, elapsed)
+
+
+def run_loadtest():
+    """ start a pmpm-websocket and run the load test against it """
+    args = parse_loadtest_args()
+    tmp = Path(tempfile.mkdtemp(prefix="pmpm-loadtest-"))
+    env = dict(os.environ, XDG_RUNTIME_DIR=str(tmp))
+    if args.citations:
+        (tmp / BIBFILE).write_text("".join(
+            f"@book{{key{k},\n  author = {{Author{k}, Ann}},\n"
+            f"  title = {{Title {k}}},\n  year = {{{2000 + k % 20}}}\n}}\n"
+            for k in range(args.citations)))
+    if not args.real_pandoc:
+        # put pmpm.fakepandoc first on the PATH as pandoc
+        (tmp / "bin").mkdir()
+        fake = tmp / "bin" / "pandoc"
+        fake.write_text(f"#!/bin/sh\nexec {sys.executable} "
+                        "-m pmpm.fakepandoc \"$@\"\n")
+        fake.chmod(0o755)
+        env["PATH"] = f"{tmp / 'bin'}{os.pathsep}{env['PATH']}"
+        env["PMPM_FAKEPANDOC_DELAY"] = str(args.pandoc_delay)
+        env["PYTHONPATH"] = os.pathsep.join(
+            p for p in [str(Path(__file__).parent.parent),
+                        env.get("PYTHONPATH")] if p)
+    # workers listen on the ports following the server's port
+    workers = [f"127.0.0.1:{int(args.port) + 1 + k}"
+               for k in range(args.workers)]
+    procs = [subprocess.Popen(
+        [sys.executable, "-m", "pmpm.workers", "--listen", w],
+        env=env,
+        stdout=subprocess.DEVNULL) for w in workers]
+    server = subprocess.Popen(
+        [sys.executable, "-c",
+         "from pmpm.websocket import run_websocket_server; "
+         "run_websocket_server()",
+         "--port", args.port, "--home", str(tmp),
+         *(["--workers", ",".join(workers)] if workers else []),
+         *args.server_args.split()],
+        env=env,
+        stdout=subprocess.DEVNULL)
+    procs.append(server)
+    try:
+        asyncio.get_event_loop().run_until_complete(
+            loadtest(args, tmp / "pmpm" / "pipe", server))
+    finally:
+        for proc in procs:
+            proc.terminate()
+            proc.wait()
+        shutil.rmtree(tmp)
+    return 0
+
+
+if __name__ == "__main__":
+    exit(run_loadtest())
@@ -0,0 +1,80 @@
+"""
+Framed pipe input, so that editors do not need to pipe the whole buffer on
+every change. A frame is either a snapshot
+    <!-- pmpm-snapshot:VERSION:PATH -->
+    the full content
+or a patch against the text of version VERSION-1
+    <!-- pmpm-patch:VERSION:CRC32:PATH -->
+    @@ START,COUNT,N
+    N lines replacing the COUNT lines starting at (0-based) line START
+    @@ ...
+where CRC32 is the zlib.crc32 of the patched text as 8 hex digits and the
+line numbers of each hunk refer to the text as patched by the hunks before.
+Lines are split at \n only. All but the last line of the last hunk have to
+end with a line break.
+"""
+
+
+import re
+import zlib
+
+
+frameRegex = re.compile(
+    '<!-- pmpm-(snapshot|patch):([0-9]+)(?::([0-9a-f]{8}))?:(.*) -->\n')
+hunkRegex = re.compile('@@ ([0-9]+),([0-9]+),([0-9]+)\n')
+
+
+def parseframe(content):
+    """ split a frame into its header fields and body
+
+    Returns:
+        kind: str: 'snapshot' or 'patch'
+        version: int
+        checksum: int or None
+        path: str: as given, i.e. relative to home or absolute
+        body: str
+    """
+    m = frameRegex.match(content)
+    if m is None or (m.group(1) == 'patch') != (m.group(3) is not None):
+        raise ValueError("malformed pmpm frame header")
+    checksum = int(m.group(3), 16) if m.group(3) else None
+    return (m.group(1), int(m.group(2)), checksum, m.group(4),
+            content[m.end():])
+
+
+def splitlines(text):
+    """ str.splitlines(keepends=True), but only at \n, like editors count """
+    lines = [line + '\n' for line in text.split('\n')]
+    lines[-1] = lines[-1][:-1]
+    return lines if lines[-1] else lines[:-1]
+
+
+def applypatch(lines, body, checksum):
+    """ apply the hunks of a patch body to lines
+
+    Args:
+        lines: list: the lines, with line endings, of the previous version
+        body: str: the hunks
+        checksum: int: the zlib.crc32 of the expected result
+
+    Returns:
+        lines: list: the lines of the new version, lines is not modified
+
+    Raises:
+        ValueError: if the patch is malformed or the checksum does not match
+    """
+    lines = list(lines)
+    patchlines = splitlines(body)
+    k = 0
+    while k < len(patchlines):
+        m = hunkRegex.fullmatch(patchlines[k])
+        if m is None:
+            raise ValueError("malformed pmpm patch hunk")
+        start, count, n = (int(g) for g in m.groups())
+        if start + count > len(lines) or k + 1 + n > len(patchlines):
+            raise ValueError("pmpm patch hunk out of range")
+        lines[start:start+count] = patchlines[k+1:k+1+n]
+        k += 1 + n
+    if zlib.crc32(''.join(lines).encode()) != checksum:
+        raise ValueError("pmpm patch checksum mismatch")
+    return lines
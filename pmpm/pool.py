@@ -0,0 +1,159 @@
+"""
+Lanes:
+    FOREGROUND, BACKGROUND, CITEPROC, PREFETCH
+    lower value is served first; the lane of a pandoc call is taken from the
+    LANE context variable, so that it does not become part of any alru_cache
+    key and is inherited by tasks created from within a lane
+PandocPool:
+    global cap on concurrently running pandoc processes,
+    plus the slots of healthy pmpm-workers if any (see workers.py),
+    waiting calls are started by (lane, arrival) on the next free slot,
+    a waiting call can be promoted to an earlier lane, e.g. when a prefetched
+    block that is cached but still waiting is needed by a foreground render
+"""
+
+
+import asyncio
+import contextvars
+from heapq import heappop, heappush
+from itertools import count
+
+
+FOREGROUND = 0
+BACKGROUND = 1
+CITEPROC = 2
+PREFETCH = 3
+
+LANE = contextvars.ContextVar('lane', default=FOREGROUND)
+
+LOCAL = 'local'
+
+
+class PandocPool:
+
+    def __init__(self, max_procs, workers=None):
+        self._free = max_procs
+        self._workers = workers
+        self._waiting = []
+        self._queued = {}
+        self._arrival = count()
+        if workers is not None:
+            workers.onfree = self._dispatch
+
+    def _take(self, remote):
+        """ reserve a free slot, a free remote worker before a local process
+
+        Returns:
+            slot: a RemoteWorker, LOCAL, or None if no slot is free
+        """
+        if remote and self._workers is not None:
+            worker = self._workers.take()
+            if worker is not None:
+                return worker
+        if self._free:
+            self._free -= 1
+            return LOCAL
+        return None
+
+    async def _acquire(self, lane, remote, key):
+        if not self._waiting:
+            slot = self._take(remote)
+            if slot is not None:
+                return slot
+        fut = asyncio.get_running_loop().create_future()
+        entry = (lane, next(self._arrival), remote, fut)
+        heappush(self._waiting, entry)
+        # identical calls may wait at the same time, e.g. a prefetch and a
+        # click on the same link, and start in any order
+        self._queued.setdefault(key, []).append(entry)
+        try:
+            return await fut
+        except asyncio.CancelledError:
+            # slot was handed over just before the cancellation arrived
+            if fut.done() and not fut.cancelled():
+                self._release(fut.result())
+            raise
+        finally:
+            entries = [e for e in self._queued.pop(key) if e[3] is not fut]
+            if entries:
+                self._queued[key] = entries
+
+    def promote(self, cmd, stdin, cwd, lane):
+        """ move the waiting calls of cmd on stdin in cwd into lane
+
+        Only ever moves a call to an earlier lane. The entry in the old lane
+        stays in the heap and is skipped by _dispatch once the call started.
+        """
+        entries = self._queued.get((tuple(cmd), stdin, cwd), [])
+        for k, entry in enumerate(entries):
+            if entry[0] > lane:
+                entries[k] = (lane,) + entry[1:]
+                heappush(self._waiting, entries[k])
+
+    def _release(self, slot):
+        if slot is LOCAL:
+            self._free += 1
+        else:
+            self._workers.give(slot)
+        self._dispatch()
+
+    def _dispatch(self):
+        while self._waiting:
+            _, _, remote, fut = self._waiting[0]
+            if fut.done():
+                heappop(self._waiting)
+                continue
+            slot = self._take(remote)
+            if slot is None:
+                return
+            heappop(self._waiting)
+            fut.set_result(slot)
+
+    async def run(self, cmd, stdin, cwd=None, job=None):
+        """ run cmd once a slot is free in the lane given by LANE
+
+        Args:
+            cmd: the pandoc call, e.g. PANDOC_CALLS['md2json'] + options
+            stdin: str: the input to pipe into pandoc
+            cwd: the working directory of the pandoc process
+            job: (call, options, files) to run cmd on a pmpm-worker instead,
+                see workers.py, None to always run cmd locally
+
+        Returns:
+            stdout: str: the decoded output of pandoc
+        """
+        slot = await self._acquire(LANE.get(), job is not None,
+                                   (tuple(cmd), stdin, cwd))
+        if slot is not LOCAL:
+            try:
+                return await slot.run(stdin, cwd, *job)
+            except (OSError, ValueError):
+                pass
+            finally:
+                self._release(slot)
+            # run it locally instead, see WorkerPool
+            return await self.run(cmd, stdin, cwd)
+        try:
+            proc = await asyncio.subprocess.create_subprocess_exec(
+                *cmd,
+                cwd=cwd,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.DEVNULL)
+            try:
+                stdout, stderr = await proc.communicate(stdin.encode())
+            except asyncio.CancelledError:
+                # e.g. evicted from an alru_cache, do not leave pandoc
+                # running beyond max_procs
+                proc.kill()
+                await proc.wait()
+                raise
+        finally:
+            self._release(slot)
+        return stdout.decode()
+
+
+async def inlane(lane, coro):
+    """ await coro with all its pandoc calls queued in lane """
+    LANE.set(lane)
+    return await coro
@@ -2,6 +2,7 @@ import argparse
 import importlib
 import os
 from pathlib import Path
+import subprocess
 
 
 BASE_DIR = Path(__file__).parent
@@ -18,6 +19,21 @@ class limport:
         return getattr(self._package, get)
 
 
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive integer")
+    return number
+
+
+def nonnegative_int(value):
+    number = int(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError(
+            f"{value} is not a non-negative integer")
+    return number
+
+
 def parse_args(args=None, websocket=False) -> argparse.Namespace:
     """ populate the pmpm command line arguments
 
@@ -50,6 +66,40 @@ def parse_args(args=None, websocket=False) -> argparse.Namespace:
         choices=["mathml", "katex"],
         help="whether to use pandoc's mathml or katex math mode",
     )
+    if websocket:
+        parser.add_argument(
+            "--max-pandoc",
+            type=positive_int,
+            default=os.environ.get("PMPM_DEFAULT_MAX_PANDOC",
+                                   os.cpu_count() or 1),
+            help="maximum number of concurrently running pandoc processes",
+        )
+        parser.add_argument(
+            "--io-threads",
+            type=positive_int,
+            default=os.environ.get("PMPM_DEFAULT_IO_THREADS", 4),
+            help="number of threads for reading files",
+        )
+        parser.add_argument(
+            "--prefetch",
+            type=nonnegative_int,
+            default=os.environ.get("PMPM_DEFAULT_PREFETCH", 8),
+            help=("maximum number of linked local .md files to pre-render "
+                  "per rendered document (0 disables prefetching)"),
+        )
+        parser.add_argument(
+            "--image-width",
+            type=int,
+            default=os.environ.get("PMPM_DEFAULT_IMAGE_WIDTH", 0),
+            help=("show local images downscaled to this width, "
+                  "requires Pillow (0 shows the original images)"),
+        )
+        parser.add_argument(
+            "--workers",
+            default=os.environ.get("PMPM_DEFAULT_WORKERS", ""),
+            help=("comma separated host:port of pmpm-worker processes "
+                  "to send pandoc calls to"),
+        )
     if not websocket:
         single_shot_arguments = parser.add_mutually_exclusive_group()
         single_shot_arguments.add_argument(
@@ -78,6 +128,54 @@ def parse_args(args=None, websocket=False) -> argparse.Namespace:
     return parsed_args
 
 
+def pandoc_calls(math):
+    """ the pandoc calls of pmpm-websocket and pmpm-worker
+
+    Args:
+        math: "mathml" or "katex"
+
+    Returns:
+        calls: dict: name -> pandoc call without the format options
+    """
+    calls = {}
+
+    # For md2json
+    calls["md2json"] = ("pandoc",
+                        "--from", "markdown+emoji",
+                        "--to", "json",
+                        "--"+math)
+    # For json2htmlblock
+    calls["json2htmlblock"] = ("pandoc",
+                               "--from", "json",
+                               "--"+math)
+
+    # For json2titleblock
+    calls["json2titleblock"] = ("pandoc",
+                                "--from", "json",
+                                "--standalone",
+                                "--"+math)
+
+    # For citeproc
+    # Since pandoc 2.11 "--filter pandoc-citeproc" should be replaced by
+    # "--citeproc". Check if we can use --citeproc.
+    proc = subprocess.Popen(
+        ("pandoc", "--citeproc"),
+        stdin=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+    proc.communicate("")
+    has_internal_citeproc = proc.returncode == 0
+
+    calls["citeproc"] = ("pandoc",
+                         "--from", "json", "--to", "html5",
+                         "--"+math)
+    if has_internal_citeproc:
+        calls["citeproc"] += ("--citeproc",)
+    else:
+        calls["citeproc"] += ("--filter", "pandoc-citeproc",)
+    return calls
+
+
 def citeblock_generator(json_input, lookup_key):
     if isinstance(json_input, dict):
         if json_input.get("t", False) == "Cite":
@@ -7,18 +7,36 @@ ReadPipeProtocol:
     buffers piped in content,
     queues and triggers processqueue when EOF or \0 received,
     PIPE_LOST event on connection_lost
+newframe:
+    snapshots and patches (see patch.py) are applied to TEXTS right away,
+    only their rendering is queued;
+    on a version or checksum mismatch the path is written to
+    RUNTIME_DIR / "resync" until the next snapshot for it arrives
 progressbar
 processqueue:
     processes queue when triggered and not yet PROCESSING
     --> new_pipe_content or new_filepath_request
 new_pipe_content:
     decodes input, resolves filepath if given
+    --> process_pipe_content
+process_pipe_content:
+    piped chapters of the shown BOOK re-render the BOOK instead
     --> process_new_content
 new_filepath_request:
     retrieves file
     --> process_new_content
 process_new_content:
     compiles message to distribute to JSCLIENTS;
+    remembers BOOK and its CHAPTERS if content has include directives
+    --> prefetchlinks
+prefetchlinks / prefetchfile:
+    renders up to ARGS.prefetch linked local .md files of the latest
+    PREFETCHQUEUE in the PREFETCH lane, one after the other and at most
+    PREFETCH_BLOCKS blocks, so that following a link mostly hits the block
+    caches; cached calls still waiting are promoted when a render needs them
+process_request:
+    plain http requests for /image?path=...&width=... are answered with
+    downscaled images (see images.py), everything else is a websocket
 serve_client / register_client / unregister_client:
     handles JSCLIENTS
     --> handle_message
@@ -26,44 +44,84 @@ readfile
 handle_message:
     JSCLIENTS send either
         filepath request: queue and trigger processqueue
+    or
+        outline: send the full OUTLINE to this client
+    or
+        refs: send the last distributed bibliography to this client
+    or
+        citations: send the full CITATIONS to this client
     or
         citeproc: trigger citeproc
 send_message_to_all_js_clients
+pandoc:
+    runs a PANDOC_CALLS entry through the PandocPool (see pool.py),
+    i.e. locally or on a pmpm-worker (see workers.py),
+    foreground blocks before background blocks before citeproc
 citeproc:
     `--filter pandoc-citeproc` is sloow,
     thus JSCLIENTS request bibliographic information only when needed,
     which is responded to by citeproc,
     or citeproc is triggered upon changed bibinfo to distribute
     new bibdetails to all clients
+    as a diff against the CITATIONS the clients have (see listdiff)
+    and the bibliography if it changed,
+    or as html of a full citeproc_sub run
+citeproc_clusters:
+    per-cluster results cached by csl and bibliography mtimes,
+    --> citeproc_update runs pandoc only on new clusters,
+    full runs if disambiguation changed or the style numbers citations
+    or has ibid forms (see citations.py)
 citeproc_sub:
     cached subprocess pandoc call
 uniqueciteprocdict
 md2json
 json2htmlblock:
     alru_cached block-wise conversion,
+    the first FOREGROUND_BLOCKS blocks go into the FOREGROUND lane,
     relative links are rewritten as file:// links,
-    onclick event allows pmpm.js to load .md links in pmpm
+    onclick event allows pmpm.js to load .md links in pmpm,
+    with --image-width local images are loaded via process_request
+book2json:
+    book mode, i.e. content with <!-- include:chapter.md --> html blocks,
+    --> chapter2json (asynchronously), one alru_cached call per chapter,
+    merged into one pandoc json with unique header ids
+relinkchapters:
+    links between chapters of a book become links within the page
+outlineindex / listdiff:
+    headers as [level, id, block position - position of previous header],
+    sent as a diff against the OUTLINE the clients have (see updateToc)
 md2htmlblocks:
-    --> md2json
+    --> md2json or book2json
     BIBQUEUE = (uniqueciteprocdict, hash, cwd) for citeproc
     --> json2htmlblock (asynchronously)
+    --> outlineindex
 """
 
 
 import asyncio
 from async_lru import alru_cache
 import concurrent.futures
-from itertools import count
+from html import unescape
+from http import HTTPStatus
+from itertools import count, repeat
 import json
 import os
 from pathlib import Path
 import re
-import subprocess
 import traceback
+from urllib.parse import parse_qs, quote, unquote, urlsplit
 import uvloop
 from socket import socket
 import websockets
-from .utils import BASE_DIR, citeblock_generator, parse_args
+from .citations import (clusterkey, clusterkeys, incrementalstyle, keycluster,
+                        parsecitations)
+from .images import (IMAGE_SUFFIXES, MAX_IMAGE_WIDTH, Image, downscaleimage,
+                     imagekey)
+from .patch import applypatch, parseframe, splitlines
+from .pool import (BACKGROUND, CITEPROC, FOREGROUND, LANE, PREFETCH,
+                   PandocPool, inlane)
+from .utils import BASE_DIR, citeblock_generator, pandoc_calls, parse_args
+from .workers import WorkerPool
 
 
 LRU_CACHE_SIZE_BLOCK = 8192
@@ -74,6 +132,26 @@ LRU_CACHE_SIZE_BLOCK = 8192
 # times after a typo or so still hits the cache, but we don't spend a lot of
 # memory even for larger .md files.
 LRU_CACHE_SIZE_FULL_FILE = 10
+# Chapters of a book are cached individually, so that all chapters of a large
+# book stay cached while one of them is being edited.
+LRU_CACHE_SIZE_CHAPTER = 256
+
+# Like pandoc's default 'toc-depth: 3', pandoc doesn't parse 'toc-depth' from
+# the YAML metadata block
+TOC_DEPTH = 3
+
+# Blocks beyond this index are rendered in the BACKGROUND lane, so that the
+# top of a large document does not wait behind thousands of other blocks.
+FOREGROUND_BLOCKS = 64
+
+# Prefetched blocks share json2htmlblock's cache with the shown document, so
+# only prefetch up to this many blocks per shown document.
+PREFETCH_BLOCKS = LRU_CACHE_SIZE_BLOCK // 4
+
+# Downscaling a large image takes up to seconds of cpu, so it gets a few
+# threads of its own instead of blocking the file reads of renders.
+IMAGE_THREADS = 2
+IMAGE_EXECUTOR = None
 
 JSCLIENTS = set()
 
@@ -83,14 +161,37 @@ EVENT_LOOP = asyncio.get_event_loop()
 QUEUE = None
 PROCESSING = False
 
+PREFETCHQUEUE = None
+PREFETCHING = False
+# (path, revealjs) -> (mtime, number of prefetched blocks)
+PREFETCHED = {}
+
 BIBQUEUE = None
 BIBPROCESSING = False
 LASTBIB = None
+# per bib context (see citeproc_clusters) the formatted citation clusters,
+# or None if citeproc output for it cannot be split into clusters
+CITECACHE = {}
+# (id, html) of the last distributed bibliography
+LASTREFS = (None, '')
+# (id, formatted clusters, bibid) of the last distributed citations
+CITATIONS = (None, [], None)
 
 RUNTIME_DIR = Path(os.environ.get("XDG_RUNTIME_DIR", "/tmp")) / "pmpm"
 PIPE_LOST = asyncio.Event()
 
+BOOK = None
+CHAPTERS = {}
+
+# (id, outline) of the last distributed content
+OUTLINE = (None, [])
+
+TEXTS = {}
+RESYNC = set()
+
 PANDOC_CALLS = {}
+POOL = None
+WORKERS = None
 
 
 def read_socket_activation_fds():
@@ -122,41 +223,7 @@ def read_socket_activation_fds():
 
 
 def init_pandoc_calls():
-
-    # For md2json
-    PANDOC_CALLS["md2json"] = ("pandoc",
-                               "--from", "markdown+emoji",
-                               "--to", "json",
-                               "--"+ARGS.math)
-    # For json2htmlblock
-    PANDOC_CALLS["json2htmlblock"] = ("pandoc",
-                                      "--from", "json",
-                                      "--"+ARGS.math)
-
-    # For json2titleblock
-    PANDOC_CALLS["json2titleblock"] = ("pandoc",
-                                       "--from", "json",
-                                       "--standalone",
-                                       "--"+ARGS.math)
-
-    # For citeproc
-    # Since pandoc 2.11 "--filter pandoc-citeproc" should be replaced by
-    # "--citeproc". Check if we can use --citeproc.
-    proc = subprocess.Popen(
-        ("pandoc", "--citeproc"),
-        stdin=subprocess.PIPE,
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.DEVNULL)
-    proc.communicate("")
-    has_internal_citeproc = proc.returncode == 0
-
-    PANDOC_CALLS["citeproc"] = ("pandoc",
-                                "--from", "json", "--to", "html5",
-                                "--"+ARGS.math)
-    if has_internal_citeproc:
-        PANDOC_CALLS["citeproc"] += ("--citeproc",)
-    else:
-        PANDOC_CALLS["citeproc"] += ("--filter", "pandoc-citeproc",)
+    PANDOC_CALLS.update(pandoc_calls(ARGS.math))
 
 
 def run_websocket_server():
@@ -185,16 +252,30 @@ def run_websocket_server():
     # Try systemd socket activation
     (fd_pipe, fd_websocket) = read_socket_activation_fds()
 
-    # Start websocket server
+    # pandoc processes are capped by POOL, file I/O and image downscaling
+    # run in a few threads each
+    global POOL
+    global IMAGE_EXECUTOR
+    if ARGS.workers:
+        global WORKERS
+        WORKERS = WorkerPool(ARGS.workers.split(','), ARGS.math)
+        WORKERS.start()
+    POOL = PandocPool(ARGS.max_pandoc, WORKERS)
     EVENT_LOOP.set_default_executor(
-        concurrent.futures.ProcessPoolExecutor(max_workers=None))
+        concurrent.futures.ThreadPoolExecutor(max_workers=ARGS.io_threads))
+    IMAGE_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+        max_workers=IMAGE_THREADS)
+
+    # Start websocket server
     if fd_websocket is not None:
         WEBSOCKETS_SERVER = websockets.serve(serve_client,
-                                             sock=socket(fileno=fd_websocket))
+                                             sock=socket(fileno=fd_websocket),
+                                             process_request=process_request)
     else:
         WEBSOCKETS_SERVER = websockets.serve(serve_client,
                                              "127.0.0.1",
-                                             ARGS.port)
+                                             ARGS.port,
+                                             process_request=process_request)
     EVENT_LOOP.run_until_complete(WEBSOCKETS_SERVER)
 
     # Start pipe server
@@ -229,9 +310,14 @@ class ReadPipeProtocol(asyncio.Protocol):
         self._received = []
 
     def data_received(self, data):
-        self._received.append(data)
-        if data.endswith(b'\0'):
+        # several frames may arrive at once, e.g. a snapshot and its first
+        # patch, and every patch has to be applied
+        *frames, rest = data.split(b'\0')
+        for frame in frames:
+            self._received.append(frame)
             self._queue()
+        if rest:
+            self._received.append(rest)
 
     def eof_received(self):
         # Send file content also on EOF, not just on \0
@@ -245,9 +331,17 @@ class ReadPipeProtocol(asyncio.Protocol):
 
     def _queue(self):
         global QUEUE
-        QUEUE = ('pipe', self._received)
-        EVENT_LOOP.create_task(processqueue())
+        instr = b''.join(self._received)
         self._received = []
+        if instr.startswith(b'<!-- pmpm-'):
+            # patches must not be coalesced, so apply them here already
+            fpath = newframe(instr)
+            if fpath is None:
+                return
+            QUEUE = ('text', fpath, TEXTS[fpath][1])
+        else:
+            QUEUE = ('pipe', instr)
+        EVENT_LOOP.create_task(processqueue())
 
     def connection_lost(self, transport):
         PIPE_LOST.set()
@@ -270,6 +364,8 @@ async def processqueue():
             q, QUEUE = QUEUE, None
             if q[0] == 'pipe':
                 await new_pipe_content(q[1])
+            elif q[0] == 'text':
+                await process_pipe_content(q[1], ''.join(q[2]))
             # assume it can only be a filepath request then
             else:
                 await new_filepath_request(
@@ -285,8 +381,50 @@ async def processqueue():
             EVENT_LOOP.create_task(processqueue())
 
 
-async def new_pipe_content(instrlist):
-    instr = b''.join(instrlist)
+def newframe(instr):
+    """ apply a snapshot or patch frame to TEXTS
+
+    Returns:
+        fpath: the absolute path of the updated text,
+            None if the frame could not be applied
+    """
+    try:
+        kind, version, checksum, path, body = parseframe(
+            instr.decode())
+    except (UnicodeDecodeError, ValueError):
+        traceback.print_exc()
+        return None
+    fpath = (ARGS.home / path).resolve()
+    if kind == 'snapshot':
+        lines = splitlines(body)
+    else:
+        try:
+            # on any mismatch the old text is useless, so it is dropped
+            base, lines = TEXTS.pop(fpath)
+            if version != base + 1:
+                raise ValueError("pmpm patch version mismatch")
+            lines = applypatch(lines, body, checksum)
+        except (KeyError, ValueError):
+            RESYNC.add(fpath)
+            writeresync()
+            return None
+    # keep only the most recently piped texts
+    TEXTS.pop(fpath, None)
+    TEXTS[fpath] = (version, lines)
+    while len(TEXTS) > LRU_CACHE_SIZE_FULL_FILE:
+        TEXTS.pop(next(iter(TEXTS)))
+    if fpath in RESYNC:
+        RESYNC.remove(fpath)
+        writeresync()
+    return fpath
+
+
+def writeresync():
+    with (RUNTIME_DIR / "resync").open('w') as f:
+        f.writelines(f"{fpath}\n" for fpath in RESYNC)
+
+
+async def new_pipe_content(instr):
     content = instr.decode()
     # filepath passed along
     if content.startswith('<!-- filepath:'):
@@ -302,6 +440,14 @@ async def new_pipe_content(instrlist):
         fpath = ARGS.home / "LIVE"
     # absolute fpath
     fpath = fpath.resolve()
+    await process_pipe_content(fpath, content)
+
+
+async def process_pipe_content(fpath, content):
+    if fpath in CHAPTERS:
+        # keep the (possibly unsaved) chapter and show the whole book
+        CHAPTERS[fpath] = content
+        fpath, content = BOOK
     await process_new_content(fpath, content)
 
 
@@ -314,8 +460,25 @@ async def new_filepath_request(fpath, revealjs):
 
 
 async def process_new_content(fpath, content):
-    htmlblocks, supbib, refsectit, bibid, toc, toctitle = await md2htmlblocks(
-        content, fpath.parent)
+    global BOOK
+    global CHAPTERS
+    chapters = []
+    if (includeRegex.search(content)
+            and not content.startswith("<!-- revealjs")):
+        # cached, md2htmlblocks converts the same content
+        chapters = bookchapters(await md2json(content, fpath.parent),
+                                fpath.parent)
+    if chapters:
+        BOOK = (fpath, content)
+        CHAPTERS = {c: CHAPTERS.get(c) for c in chapters}
+    else:
+        BOOK = None
+        CHAPTERS = {}
+    (htmlblocks, supbib, refsectit, bibid, toc, toctitle,
+     outline) = await md2htmlblocks(content, fpath.parent)
+    global OUTLINE
+    base, OUTLINE = OUTLINE, (hash(tuple(map(tuple, outline))), outline)
+    start, delete, insert = listdiff(base[1], outline)
     message = {
         "filepath": str(fpath.relative_to(ARGS.home)),
         "htmlblocks": htmlblocks,
@@ -323,9 +486,113 @@ async def process_new_content(fpath, content):
         "reference-section-title": refsectit,
         "bibid": bibid,
         "toc": toc,
-        "toc-title": toctitle
+        "toc-title": toctitle,
+        "outline": {"base": base[0],
+                    "id": OUTLINE[0],
+                    "start": start,
+                    "delete": delete,
+                    "insert": insert}
         }
     EVENT_LOOP.create_task(send_message_to_all_js_clients(message))
+    global PREFETCHQUEUE
+    PREFETCHQUEUE = (fpath, htmlblocks, content.startswith("<!-- revealjs"))
+    EVENT_LOOP.create_task(prefetchlinks())
+
+
+localLinkRegex = re.compile('href="file://([^"#]*\\.md)(?:#[^"]*)?"')
+
+
+async def prefetchlinks():
+    global PREFETCHING
+    global PREFETCHQUEUE
+    if not PREFETCHING and PREFETCHQUEUE:
+        try:
+            PREFETCHING = True
+            LANE.set(PREFETCH)
+            (fpath, htmlblocks, revealjs), PREFETCHQUEUE = PREFETCHQUEUE, None
+            targets = []
+            for _, html in htmlblocks:
+                for link in localLinkRegex.findall(html):
+                    target = Path(unquote(unescape(link))).resolve()
+                    if (target != fpath
+                            and target not in targets
+                            and ARGS.home in target.parents):
+                        targets.append(target)
+            # leave the blocks of the shown document in json2htmlblock's cache
+            budget = min(PREFETCH_BLOCKS,
+                         LRU_CACHE_SIZE_BLOCK - len(htmlblocks))
+            for target in targets[:ARGS.prefetch]:
+                if budget <= 0:
+                    break
+                budget -= await prefetchfile(target, revealjs, budget)
+        finally:
+            PREFETCHING = False
+        EVENT_LOOP.create_task(prefetchlinks())
+
+
+async def prefetchfile(fpath, revealjs, budget):
+    """ render fpath into the block caches, unless it has more than budget
+    blocks; files are only read again once they changed on disk
+
+    Returns:
+        nblocks: int: the number of blocks prefetched
+    """
+    try:
+        mtime = fpath.stat().st_mtime
+    except OSError:
+        return 0
+    if PREFETCHED.get((fpath, revealjs), (None,))[0] == mtime:
+        return PREFETCHED[(fpath, revealjs)][1]
+    try:
+        content = await EVENT_LOOP.run_in_executor(None,
+                                                   readfile,
+                                                   fpath)
+        htmlblocks = await md2htmlblocks(
+            "<!-- revealjs -->" + content if revealjs else content,
+            fpath.parent,
+            prefetch=budget)
+    except (OSError, UnicodeDecodeError, ValueError):
+        # links to broken or non-markdown files are simply not prefetched
+        htmlblocks = None
+    nblocks = 0 if htmlblocks is None else len(htmlblocks[0])
+    PREFETCHED.pop((fpath, revealjs), None)
+    PREFETCHED[(fpath, revealjs)] = (mtime, nblocks)
+    while len(PREFETCHED) > LRU_CACHE_SIZE_CHAPTER:
+        PREFETCHED.pop(next(iter(PREFETCHED)))
+    return nblocks
+
+
+async def process_request(path, request_headers):
+    """ answer /image requests, let websockets handle everything else """
+    if not path.startswith('/image?'):
+        return None
+    query = parse_qs(urlsplit(path).query)
+    try:
+        fpath = Path(query['path'][0]).resolve()
+        width = min(int(query['width'][0]), MAX_IMAGE_WIDTH)
+    except (KeyError, ValueError):
+        return (HTTPStatus.BAD_REQUEST, [], b'')
+    # only serve images, and only those below home
+    if (Image is None
+            or width <= 0
+            or fpath.suffix.lower() not in IMAGE_SUFFIXES
+            or ARGS.home not in fpath.parents):
+        return (HTTPStatus.FORBIDDEN, [], b'')
+    try:
+        mtime = fpath.stat().st_mtime
+    except OSError:
+        return (HTTPStatus.NOT_FOUND, [], b'')
+    etag = f'"{imagekey(fpath, mtime, width)}"'
+    headers = [('Cache-Control', 'no-cache'), ('ETag', etag)]
+    if request_headers.get('If-None-Match') == etag:
+        return (HTTPStatus.NOT_MODIFIED, headers, b'')
+    try:
+        data, content_type = await EVENT_LOOP.run_in_executor(
+            IMAGE_EXECUTOR, downscaleimage, fpath, mtime, width)
+    except (OSError, Image.DecompressionBombError):
+        traceback.print_exc()
+        return (HTTPStatus.INTERNAL_SERVER_ERROR, [], b'')
+    return (HTTPStatus.OK, headers + [('Content-Type', content_type)], data)
 
 
 async def serve_client(client: websockets.WebSocketServerProtocol, path: str):
@@ -388,6 +655,27 @@ async def handle_message(client: websockets.WebSocketServerProtocol,
     elif message.startswith('revealjs:filepath:'):
         QUEUE = ('revealjsfilepath', ARGS.home / message[18:])
         EVENT_LOOP.create_task(processqueue())
+    # outline diffs did not fit the outline the client has
+    elif message == 'outline':
+        EVENT_LOOP.create_task(client.send(json.dumps(
+            {"outline-full": OUTLINE[1], "outline-id": OUTLINE[0]})))
+    # the client missed the last distributed bibliography
+    elif message == 'refs':
+        EVENT_LOOP.create_task(client.send(json.dumps(
+            {"refs": LASTREFS[1], "refsid": LASTREFS[0]})))
+    # citation diffs did not fit the citations the client has, unless an
+    # html result is on its way
+    elif message == 'citations':
+        if CITATIONS[0] is None:
+            return
+        EVENT_LOOP.create_task(client.send(json.dumps(
+            {"citations": {"base": None,
+                           "id": CITATIONS[0],
+                           "start": 0,
+                           "delete": 0,
+                           "insert": CITATIONS[1]},
+             "refsid": LASTREFS[0],
+             "bibid": CITATIONS[2]})))
     # assume it can only be a citeproc request then
     else:
         EVENT_LOOP.create_task(citeproc())
@@ -406,19 +694,59 @@ async def send_message_to_all_js_clients(message):
             EVENT_LOOP.create_task(client.send(jsonmessage))
 
 
+async def pandoc(call, stdin, cwd=None, options=(), files=()):
+    """ run a pandoc call, files=None keeps it off remote workers """
+    job = None if files is None else (call, options, files)
+    return await POOL.run(PANDOC_CALLS[call] + options, stdin, cwd, job=job)
+
+
+def promote(call, stdin, cwd=None, options=()):
+    """ move a waiting pandoc call into the current lane
+
+    alru_cached calls of a prefetch keep waiting in the PREFETCH lane
+    even once a foreground render awaits the same cached call.
+    """
+    POOL.promote(PANDOC_CALLS[call] + options, stdin, cwd, LANE.get())
+
+
 async def citeproc():
     global BIBPROCESSING
     global BIBQUEUE
+    global LASTREFS
+    global CITATIONS
     if not BIBPROCESSING and BIBQUEUE:
         try:
+            LANE.set(CITEPROC)
             q, BIBQUEUE, BIBPROCESSING = BIBQUEUE, None, True
+            message = {'html': '', 'bibid': q[1]}
             if q[0] and q[1]:
-                citehtml = await EVENT_LOOP.create_task(citeproc_sub(*q))
-            else:
-                citehtml = ''
+                clusters = await EVENT_LOOP.create_task(
+                    citeproc_clusters(q[0], q[2]))
+                if clusters is None:
+                    message['html'] = await EVENT_LOOP.create_task(
+                        citeproc_sub(*q))
+                else:
+                    # only send the changed clusters and, if it changed,
+                    # the bibliography
+                    base, CITATIONS = CITATIONS, (hash(tuple(clusters[0])),
+                                                  clusters[0],
+                                                  q[1])
+                    start, delete, insert = listdiff(base[1], clusters[0])
+                    message = {'citations': {'base': base[0],
+                                             'id': CITATIONS[0],
+                                             'start': start,
+                                             'delete': delete,
+                                             'insert': insert},
+                               'refsid': hash(clusters[1]),
+                               'bibid': q[1]}
+                    if LASTREFS[0] != message['refsid']:
+                        LASTREFS = message['refsid'], clusters[1]
+                        message['refs'] = clusters[1]
+            # the clients drop their citations on html results
+            if 'html' in message:
+                CITATIONS = (None, [], None)
             EVENT_LOOP.create_task(
-                send_message_to_all_js_clients({'html': citehtml,
-                                                'bibid': q[1]}))
+                send_message_to_all_js_clients(message))
         finally:
             BIBPROCESSING = False
         EVENT_LOOP.create_task(citeproc())
@@ -427,17 +755,125 @@ async def citeproc():
 @alru_cache(maxsize=LRU_CACHE_SIZE_FULL_FILE)
 async def citeproc_sub(jsondump, bibid, cwd):
     if jsondump and bibid:
-        proc = await asyncio.subprocess.create_subprocess_exec(
-            *PANDOC_CALLS['citeproc'],
-            cwd=cwd,
-            stdin=asyncio.subprocess.PIPE,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.DEVNULL)
-        stdout, stderr = await proc.communicate(jsondump.encode())
-        return stdout.decode()
+        return await pandoc('citeproc', jsondump, cwd,
+                            files=citeprocfiles(json.loads(jsondump)['meta']))
     return ''
 
 
+async def citeproc_clusters(jsondump, cwd):
+    """ incremental citeproc, only formats citation clusters not seen before
+
+    Args:
+        jsondump: str: the uniqueciteprocdict
+        cwd: the directory of the document
+
+    Returns:
+        citations: list: formatted html of each citeblock, in order
+        refs: str: the bibliography html
+        or None, if the style or citeproc output needs citeproc_sub instead
+    """
+    bibinfo = json.loads(jsondump)
+    csl = cslfile(bibinfo['meta'])
+    if csl is not None and not incrementalstyle(
+            cwd / csl, bibinfo.get('csl_mtime_')):
+        return None
+    blocks = bibinfo.pop('blocks')
+    # csl, bibliography mtimes and other bib-relevant metadata
+    context = json.dumps(bibinfo)
+    clusters = [clusterkey(b) for b in blocks]
+    keys = sorted({k for b in blocks for k in clusterkeys(b)})
+
+    if context in CITECACHE and CITECACHE[context] is None:
+        # the citeproc output could not be split into clusters before
+        CITECACHE[context] = CITECACHE.pop(context)
+        return None
+    state = CITECACHE.pop(context, None)
+    try:
+        if state is not None:
+            missing = list(dict.fromkeys(
+                c for c in clusters if c not in state['clusters']))
+            if missing or keys != state['keys']:
+                state = await citeproc_update(bibinfo, cwd, state,
+                                              missing, keys)
+        if state is None:
+            state = await citeproc_update(bibinfo, cwd, None,
+                                          list(dict.fromkeys(clusters)), keys)
+    except ValueError:
+        # remember, so that every further edit runs citeproc_sub only
+        state = None
+    CITECACHE[context] = state
+    while len(CITECACHE) > LRU_CACHE_SIZE_FULL_FILE:
+        del CITECACHE[next(iter(CITECACHE))]
+    if state is None:
+        return None
+    if len(state['clusters']) > LRU_CACHE_SIZE_BLOCK:
+        state['clusters'] = {c: state['clusters'][c] for c in clusters}
+    return [state['clusters'][c] for c in clusters], state['refs']
+
+
+async def citeproc_update(bibinfo, cwd, state, missing, keys):
+    """ format the missing clusters and one keycluster per cited key
+
+    The keyclusters and bibliography entries of keys already in state must
+    come out unchanged, otherwise adding or removing a citation changed the
+    disambiguation of other citations and state is discarded (None).
+
+    Raises:
+        ValueError: if the citeproc output cannot be split into clusters
+    """
+    doc = dict(bibinfo, blocks=[json.loads(c) for c in missing]
+               + [keycluster(k) for k in keys])
+    html = await pandoc('citeproc', json.dumps(doc), cwd,
+                        files=citeprocfiles(bibinfo['meta']))
+    parsed = parsecitations(html, len(doc['blocks']))
+    if parsed is None:
+        raise ValueError("unexpected citeproc output")
+    citations, refs, entries = parsed
+    singles = dict(zip(keys, citations[len(missing):]))
+    if state is None:
+        state = {'clusters': {}, 'singles': {}, 'entries': {}}
+    elif any(singles[k] != state['singles'][k]
+             or entries.get(k) != state['entries'].get(k)
+             for k in state['singles'].keys() & singles.keys()):
+        return None
+    state['clusters'].update(zip(missing, citations))
+    state['singles'] = singles
+    state['entries'] = entries
+    state['keys'] = keys
+    state['refs'] = refs
+    return state
+
+
+def citeprocfiles(meta):
+    if WORKERS is None:
+        return ()
+    # remote workers may not see cwd, so send the files along
+    files = bibliographyfiles(meta)
+    if cslfile(meta) is not None:
+        files.append(cslfile(meta))
+    # workers only write files below their temporary directory, so calls
+    # needing files elsewhere run locally
+    if any(Path(f).is_absolute() or '..' in Path(f).parts for f in files):
+        return None
+    return files
+
+
+def bibliographyfiles(meta):
+    bibliography = meta.get('bibliography', None)
+    if not bibliography:
+        return []
+    if bibliography['t'] == 'MetaInlines':
+        return [bibliography['c'][0]['c']]
+    return [b['c'][0]['c'] for b in bibliography['c']]
+
+
+def cslfile(meta):
+    try:
+        return meta['csl']['c'][0]['c']
+    except (IndexError, KeyError, TypeError):
+        return None
+
+
 async def uniqueciteprocdict(jsondict, cwd):
     # keep only the blocks and bib-relevant metadata
     metakeys = {'bibliography',
@@ -457,22 +893,16 @@ async def uniqueciteprocdict(jsondict, cwd):
         return (None, None)
 
     # add bibliography_mtimes_ to uniqueify
-    bibliography = bibinfo['meta'].get('bibliography', None)
-    if bibliography:
-        if bibliography['t'] == 'MetaInlines':
-            bibfiles = [cwd / bibliography['c'][0]['c']]
-        else:
-            bibfiles = [cwd / b['c'][0]['c']
-                        for b in bibliography['c']]
-        bibinfo['bibliography_mtimes_'] = [b.stat().st_mtime
+    bibfiles = bibliographyfiles(bibinfo['meta'])
+    if bibfiles:
+        bibinfo['bibliography_mtimes_'] = [(cwd / b).stat().st_mtime
                                            for b in bibfiles]
 
     # add csl_mtime_ to uniqueify
     try:
-        bibinfo['csl_mtime_'] = (
-            cwd / bibinfo['meta']['csl']['c'][0]['c']
-            ).stat().st_mtime
-    except (FileNotFoundError, IndexError, KeyError, TypeError):
+        bibinfo['csl_mtime_'] = (cwd / cslfile(bibinfo['meta'])
+                                 ).stat().st_mtime
+    except (FileNotFoundError, TypeError):
         pass
 
     info = json.dumps(bibinfo)
@@ -481,36 +911,208 @@ async def uniqueciteprocdict(jsondict, cwd):
 
 @alru_cache(maxsize=LRU_CACHE_SIZE_FULL_FILE)
 async def md2json(content, cwd):
-    proc = await asyncio.subprocess.create_subprocess_exec(
-        *PANDOC_CALLS['md2json'],
-        cwd=cwd,
-        stdin=asyncio.subprocess.PIPE,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.DEVNULL)
-    stdout, stderr = await proc.communicate(content.encode())
-    return json.loads(stdout.decode())
+    return json.loads(await pandoc('md2json', content, cwd))
+
+
+@alru_cache(maxsize=LRU_CACHE_SIZE_CHAPTER)
+async def chapter2json(content, cwd):
+    return await md2json.__wrapped__(content, cwd)
+
+
+includeRegex = re.compile('^<!-- include:(.*) -->$', re.MULTILINE)
+
+
+def includedchapters(block, cwd):
+    """ the chapters a top-level html block of include directives includes
+
+    Only raw html blocks count, so that include directives in code blocks
+    are shown and not followed.
+
+    Returns:
+        chapters: list: absolute paths, or None if block is no such block
+    """
+    if block['t'] != 'RawBlock' or block['c'][0] != 'html':
+        return None
+    matches = [includeRegex.fullmatch(line)
+               for line in block['c'][1].strip().split('\n')]
+    if None in matches:
+        return None
+    return [(cwd / m.group(1)).resolve() for m in matches]
+
+
+def bookchapters(jsonin, cwd):
+    return [chapter
+            for b in jsonin['blocks']
+            for chapter in includedchapters(b, cwd) or ()]
+
+
+def headerids(blocks):
+    for b in blocks:
+        if b['t'] == 'Header':
+            yield b['c'][1][0]
+        elif b['t'] == 'Div':
+            yield from headerids(b['c'][1])
+
+
+def jsonnodes(j):
+    if isinstance(j, dict):
+        yield j
+        yield from jsonnodes(j.get('c'))
+    elif isinstance(j, list):
+        for x in j:
+            yield from jsonnodes(x)
+
+
+@alru_cache(maxsize=LRU_CACHE_SIZE_CHAPTER)
+async def renamedchapter(content, cwd, renames):
+    """ chapter2json with header ids and #links renamed by renames """
+    renames = dict(renames)
+    jsonout = json.loads(json.dumps(await chapter2json(content, cwd)))
+    for node in jsonnodes(jsonout['blocks']):
+        if node.get('t') == 'Header':
+            attr = node['c'][1]
+            attr[0] = renames.get(attr[0], attr[0])
+        elif node.get('t') == 'Link':
+            target = node['c'][2]
+            if target[0].startswith('#') and target[0][1:] in renames:
+                target[0] = '#' + renames[target[0][1:]]
+    return jsonout
+
+
+async def book2json(jsonin, cwd):
+    """ merge the chapters included by top-level include directives
+
+    Every chapter is converted separately and cached, so that editing one
+    chapter only converts that chapter again. The metadata of the book is
+    that of the main file. Chapters that are currently piped in are taken
+    from CHAPTERS instead of from disk, chapters that cannot be read are
+    shown as a placeholder. Like pandoc, header ids that are already taken
+    get a suffix -1, -2, ..., and links within the chapter follow.
+
+    Returns:
+        jsonout: dict: the merged pandoc json
+        blockcwds: list: the directory of the file each block stems from
+        anchors: dict: per chapter the id of its first header and renames
+    """
+    parts = []
+    for b in jsonin['blocks']:
+        chapters = includedchapters(b, cwd)
+        if chapters is not None:
+            parts += chapters
+        elif parts and not isinstance(parts[-1], Path):
+            parts[-1].append(b)
+        else:
+            parts.append([b])
+    if not any(isinstance(p, Path) for p in parts):
+        return jsonin, repeat(cwd), {}
+
+    async def part2json(chapter):
+        text = CHAPTERS.get(chapter)
+        try:
+            if text is None:
+                text = await EVENT_LOOP.run_in_executor(None, readfile,
+                                                        chapter)
+        except (OSError, UnicodeDecodeError):
+            return None, [{"t": "Para",
+                           "c": [{"t": "Emph",
+                                  "c": [{"t": "Str",
+                                         "c": f"{chapter} not found"}]}]}]
+        promote('md2json', text, chapter.parent)
+        return text, (await chapter2json(text, chapter.parent))['blocks']
+
+    chapters = [p for p in parts if isinstance(p, Path)]
+    jsons = dict(zip(chapters, await asyncio.gather(
+        *(part2json(c) for c in chapters))))
+
+    used = set(headerids(jsonin['blocks']))
+    jsonout = {"blocks": [],
+               "meta": jsonin['meta'],
+               "pandoc-api-version": jsonin['pandoc-api-version']}
+    blockcwds = []
+    anchors = {}
+    for p in parts:
+        if not isinstance(p, Path):
+            jsonout['blocks'] += p
+            blockcwds += [cwd] * len(p)
+            continue
+        text, blocks = jsons[p]
+        renames = {}
+        for ident in headerids(blocks):
+            if ident and ident in used:
+                n = 1
+                while f"{ident}-{n}" in used:
+                    n += 1
+                renames[ident] = f"{ident}-{n}"
+            used.add(renames.get(ident, ident))
+        if renames:
+            blocks = (await renamedchapter(text, p.parent,
+                                           tuple(renames.items())))['blocks']
+        jsonout['blocks'] += blocks
+        blockcwds += [p.parent] * len(blocks)
+        anchors[p] = (next(headerids(blocks), ''), renames)
+    return jsonout, blockcwds, anchors
+
+
+chapterLinkRegex = re.compile(
+    'href="file://([^"#]*\\.md)(?:#([^"]*))?" '
+    'onclick="return localLinkClickEvent\\(this\\);"')
+
+
+def relinkchapters(htmlblock, anchors):
+    if 'file://' not in htmlblock[1]:
+        return htmlblock
+
+    def relink(m):
+        chapter = Path(unquote(unescape(m.group(1)))).resolve()
+        if chapter not in anchors:
+            return m.group(0)
+        first, renames = anchors[chapter]
+        if m.group(2) is None:
+            return f'href="#{first}"'
+        return f'href="#{renames.get(m.group(2), m.group(2))}"'
+
+    html = chapterLinkRegex.sub(relink, htmlblock[1])
+    if html == htmlblock[1]:
+        return htmlblock
+    return [hash(html), html]
+
+
+async def htmlblock(jsontxt, cwd, options):
+    promote('json2htmlblock', jsontxt, cwd, options)
+    return await json2htmlblock(jsontxt, cwd, options)
 
 
 @alru_cache(maxsize=LRU_CACHE_SIZE_BLOCK)
 async def json2htmlblock(jsontxt, cwd, options):
-    return await EVENT_LOOP.run_in_executor(
-        None, json2htmlblock_sub, jsontxt, cwd, options)
+    return json2htmlblock_sub(
+        await pandoc('json2htmlblock', jsontxt, cwd, options),
+        cwd, options)
 
 
 urlRegex = re.compile('(href|src)=[\'"](?!/|https://|http://|#)(.*)[\'"]')
 
 
-def json2htmlblock_sub(jsontxt, cwd, options):
-    proc = subprocess.Popen(
-        PANDOC_CALLS["json2htmlblock"] + options,
-        cwd=cwd,
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.DEVNULL)
-    stdout, stderr = proc.communicate(jsontxt.encode())
+imgRegex = re.compile('<img src="(?!https://|http://|data:)([^"]*)"')
+
+
+def proxyimg(m, cwd):
+    src = m.group(1)
+    fpath = cwd / unquote(unescape(src))
+    if fpath.suffix.lower() not in IMAGE_SUFFIXES:
+        return m.group(0)
+    full = src if src.startswith('/') else f"{cwd}/{src}"
+    return (f'<img src="http://127.0.0.1:{ARGS.port}/image'
+            f'?path={quote(str(fpath))}&amp;width={ARGS.image_width}" '
+            f'data-full="file://{full}" '
+            'onclick="return imageClickEvent(this);"')
+
+
+def json2htmlblock_sub(stdout, cwd, options):
+    if ARGS.image_width > 0 and Image is not None:
+        stdout = imgRegex.sub(lambda m: proxyimg(m, cwd), stdout)
     html = urlRegex.sub(
         f'\\1="file://{cwd}/\\2" onclick="return localLinkClickEvent(this);"',
-        stdout.decode())
+        stdout)
     if "revealjs" in options and html.startswith("<section>\n"):
         html = html[10:-11]
     return [hash(html), html]
@@ -518,14 +1120,7 @@ def json2htmlblock_sub(jsontxt, cwd, options):
 
 @alru_cache(maxsize=LRU_CACHE_SIZE_BLOCK)
 async def json2titleblock(jsontxt, options):
-    proc = await asyncio.subprocess.create_subprocess_exec(
-        *PANDOC_CALLS["json2titleblock"],
-        *options,
-        stdin=asyncio.subprocess.PIPE,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.DEVNULL)
-    stdout, stderr = await proc.communicate(jsontxt.encode())
-    out = stdout.decode()
+    out = await pandoc('json2titleblock', jsontxt, None, options)
     if "revealjs" in options:
         start = out.find('<section id="title-slide">')
         end = out.find('</section>', start) + 10
@@ -555,15 +1150,57 @@ def groupsections(blocks, slidelevel):
         yield section
 
 
+def outlinegenerator(blocks):
+    """ the headers as (level, id, index of their top-level block)
+
+    Includes headers nested in divs, block quotes, lists, ... like pandoc's
+    toc; like there, headers written as raw html are not included.
+    """
+    for k, b in enumerate(blocks):
+        for node in jsonnodes(b):
+            if node.get('t') == 'Header' and node['c'][0] <= TOC_DEPTH:
+                yield node['c'][0], node['c'][1][0], k
+
+
+def outlineindex(blocks, offset):
+    """ the headers in blocks as [level, id, dpos]
+
+    dpos is the position of the header's htmlblock minus that of the
+    previous header, so that inserting a block changes at most one entry
+    """
+    outline = []
+    last = 0
+    for level, ident, pos in outlinegenerator(blocks):
+        outline.append([level, ident, pos + offset - last])
+        last = pos + offset
+    return outline
+
+
+def listdiff(old, new):
+    """ new == old[:start] + insert + old[start+delete:] """
+    n = min(len(old), len(new))
+    start = 0
+    while start < n and old[start] == new[start]:
+        start += 1
+    end = 0
+    while end < n - start and old[-1-end] == new[-1-end]:
+        end += 1
+    return start, len(old) - start - end, new[start:len(new)-end]
+
+
 # do not cache --> checkforbibdifferences
-async def md2htmlblocks(content, cwd):
+async def md2htmlblocks(content, cwd, prefetch=None):
     """ convert markdown to html using pandoc markdown
 
     Args:
         content: the markdown string to convert
+        prefetch: maximum number of blocks to only warm the block caches
+            with, i.e. neither touch the few md2json entries nor the BIBQUEUE
+            of the shown document
 
     Returns:
-        html: str: the resulting html
+        html: str: the resulting html,
+            None if a prefetch would exceed its number of blocks
 
     """
     options = ("--to", "html5")
@@ -580,7 +1217,14 @@ async def md2htmlblocks(content, cwd):
             content = content[18:]
         options = ("--to", "revealjs") + ("--slide-level", slidelevel)
 
-    jsonout = await EVENT_LOOP.create_task(md2json(content, cwd))
+    blockcwds = repeat(cwd)
+    anchors = {}
+    if prefetch is not None:
+        jsonout = await md2json.__wrapped__(content, cwd)
+    else:
+        jsonout = await EVENT_LOOP.create_task(md2json(content, cwd))
+    if "revealjs" not in options and includeRegex.search(content):
+        jsonout, blockcwds, anchors = await book2json(jsonout, cwd)
 
     # blocks are grouped into slidesections
     if "revealjs" in options:
@@ -588,22 +1232,27 @@ async def md2htmlblocks(content, cwd):
     else:
         blocks = ([j] for j in jsonout['blocks'])
 
-    global BIBQUEUE
-    BIBQUEUE = *(await uniqueciteprocdict(jsonout, cwd)), cwd
-    bibid = BIBQUEUE[1]
-    EVENT_LOOP.create_task(citeproc())
+    if prefetch is not None:
+        if len(jsonout['blocks']) > prefetch:
+            return None
+        bibid = None
+    else:
+        global BIBQUEUE
+        BIBQUEUE = *(await uniqueciteprocdict(jsonout, cwd)), cwd
+        bibid = BIBQUEUE[1]
+        EVENT_LOOP.create_task(citeproc())
 
     # []
-    titleblock = await json2titleblock(
-        json.dumps({
-            "blocks": [],
-            "meta": {k: jsonout['meta'][k]
-                     for k in {"title",
-                               "subtitle",
-                               "author",
-                               "date"} & jsonout['meta'].keys()},
-            "pandoc-api-version": jsonout['pandoc-api-version']}),
-        options)
+    titlejson = json.dumps({
+        "blocks": [],
+        "meta": {k: jsonout['meta'][k]
+                 for k in {"title",
+                           "subtitle",
+                           "author",
+                           "date"} & jsonout['meta'].keys()},
+        "pandoc-api-version": jsonout['pandoc-api-version']})
+    promote('json2titleblock', titlejson, None, options)
+    titleblock = await json2titleblock(titlejson, options)
 
     jsonlist = (
         json.dumps({"blocks": j,
@@ -611,9 +1260,15 @@ async def md2htmlblocks(content, cwd):
                     "pandoc-api-version": jsonout['pandoc-api-version']})
         for j in blocks)
 
+    # blocks of a prefetch (or other low priority) render keep their lane
+    lane = LANE.get()
     htmlblocks = await asyncio.gather(*(
-        json2htmlblock(j, cwd, options)
-        for j in jsonlist))
+        inlane(lane if lane != FOREGROUND or k < FOREGROUND_BLOCKS
+               else BACKGROUND,
+               htmlblock(j, c, options))
+        for k, (j, c) in enumerate(zip(jsonlist, blockcwds))))
+    if anchors:
+        htmlblocks = [relinkchapters(b, anchors) for b in htmlblocks]
 
     try:
         supbib = jsonout['meta']['suppress-bibliography']['c'] is True
@@ -635,9 +1290,15 @@ async def md2htmlblocks(content, cwd):
     except (IndexError, KeyError):
         toctitle = None
 
+    if "revealjs" in options:
+        outline = []
+    else:
+        outline = outlineindex(jsonout['blocks'], len(titleblock))
+
     return (titleblock + htmlblocks,
             supbib,
             refsectit,
             bibid,
             toc,
-            toctitle)
+            toctitle,
+            outline)
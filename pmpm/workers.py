@@ -0,0 +1,339 @@
+"""
+pmpm-worker: runs pandoc calls for a pmpm-websocket on another host
+
+Protocol:
+    every message is 4 bytes big-endian length followed by a json object;
+    the server sends
+        {"id": n, "ping": true}
+            answered by {"id": n, "slots": concurrent pandoc calls}
+        {"id": n, "call": name, "options": [...], "math": ...,
+         "stdin": ..., "cwd": ..., "files": {name: content}}
+            answered by {"id": n, "stdout": ...} or {"id": n, "error": ...}
+    name is a key of utils.pandoc_calls, so that only pandoc is ever run;
+    the worker runs in cwd if it exists there (shared filesystem),
+    otherwise in a temporary directory holding the sent files
+run_worker():
+    entry point of pmpm-worker, exits if pandoc does not work
+RemoteWorker:
+    connection of pmpm-websocket to one pmpm-worker,
+    pings every HEALTH_INTERVAL, reconnects when the worker is lost
+WorkerPool:
+    the slots of all healthy workers, handed out by PandocPool (see pool.py)
+    to the least busy worker; failed calls are run locally, as are calls
+    that get no answer within JOB_TIMEOUT
+"""
+
+
+import argparse
+import asyncio
+from itertools import count
+import json
+import os
+from pathlib import Path
+import re
+import subprocess
+import sys
+import tempfile
+from .pool import PandocPool
+from .utils import pandoc_calls, positive_int
+
+
+HEALTH_INTERVAL = 5
+HEALTH_TIMEOUT = 2
+# pmpm-worker gives up on a pandoc call after JOB_TIMEOUT seconds
+JOB_TIMEOUT = 120
+
+optionRegex = re.compile('[a-z0-9]+')
+
+
+async def readmessage(reader):
+    n = int.from_bytes(await reader.readexactly(4), 'big')
+    return json.loads(await reader.readexactly(n))
+
+
+def writemessage(writer, message):
+    data = json.dumps(message).encode()
+    writer.write(len(data).to_bytes(4, 'big') + data)
+
+
+class RemoteWorker:
+
+    def __init__(self, address, math, onup):
+        host, port = address.rsplit(':', 1)
+        self.address = address
+        self._host = host
+        self._port = int(port)
+        self._math = math
+        self._onup = onup
+        self._writer = None
+        self._pending = {}
+        self._ids = count()
+        self.slots = 0
+        self.outstanding = 0
+
+    @property
+    def healthy(self):
+        return self.slots > 0
+
+    async def _request(self, message):
+        if self._writer is None:
+            raise ConnectionError(self.address)
+        message['id'] = next(self._ids)
+        fut = asyncio.get_running_loop().create_future()
+        self._pending[message['id']] = fut
+        try:
+            writemessage(self._writer, message)
+            return await fut
+        finally:
+            self._pending.pop(message['id'], None)
+
+    async def _read(self, reader):
+        try:
+            while True:
+                response = await readmessage(reader)
+                fut = self._pending.get(response['id'])
+                if fut is not None and not fut.done():
+                    fut.set_result(response)
+        except (OSError, asyncio.IncompleteReadError, ValueError):
+            pass
+        # do not wait for the next ping to hand pending calls back
+        self._fail()
+
+    def _fail(self):
+        if self.healthy:
+            print(f"pmpm-worker {self.address} is down")
+        self.slots = 0
+        for fut in self._pending.values():
+            if not fut.done():
+                fut.set_exception(ConnectionError(self.address))
+
+    async def monitor(self):
+        while True:
+            reading = None
+            try:
+                reader, self._writer = await asyncio.wait_for(
+                    asyncio.open_connection(self._host, self._port),
+                    HEALTH_TIMEOUT)
+                reading = asyncio.ensure_future(self._read(reader))
+                while not reading.done():
+                    pong = await asyncio.wait_for(
+                        self._request({"ping": True}), HEALTH_TIMEOUT)
+                    if not self.healthy:
+                        print(f"pmpm-worker {self.address} is up")
+                    self.slots = pong['slots']
+                    self._onup()
+                    await asyncio.sleep(HEALTH_INTERVAL)
+            except (OSError, asyncio.TimeoutError):
+                pass
+            self._fail()
+            if reading is not None:
+                reading.cancel()
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+            await asyncio.sleep(HEALTH_INTERVAL)
+
+    async def run(self, stdin, cwd, call, options, files):
+        """ run a pandoc call on this worker
+
+        Args:
+            stdin: str: the input to pipe into pandoc
+            cwd: the working directory of the pandoc process
+            call: str: key of utils.pandoc_calls
+            options: tuple: format options, like ("--to", "html5")
+            files: list: names of files relative to cwd the call needs
+
+        Returns:
+            stdout: str: the decoded output of pandoc
+
+        Raises:
+            ConnectionError: if the worker is lost
+            ValueError: if the worker could not run the call
+        """
+        if files:
+            files = await asyncio.get_running_loop().run_in_executor(
+                None, readfiles, cwd, files)
+        try:
+            response = await asyncio.wait_for(
+                self._request({"call": call,
+                               "options": list(options),
+                               "math": self._math,
+                               "stdin": stdin,
+                               "cwd": None if cwd is None else str(cwd),
+                               "files": files or {}}),
+                JOB_TIMEOUT + HEALTH_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise ConnectionError(f"pmpm-worker {self.address}: "
+                                  "no answer") from None
+        if 'error' in response:
+            raise ValueError(f"pmpm-worker {self.address}: "
+                             f"{response['error']}")
+        return response['stdout']
+
+
+class WorkerPool:
+
+    def __init__(self, addresses, math):
+        self.onfree = None
+        self._workers = [RemoteWorker(a, math, self._onup) for a in addresses]
+
+    def _onup(self):
+        if self.onfree is not None:
+            self.onfree()
+
+    def start(self):
+        for worker in self._workers:
+            asyncio.ensure_future(worker.monitor())
+
+    def take(self):
+        """ reserve a slot on the least busy healthy worker, if any is free """
+        free = [w for w in self._workers
+                if w.healthy and w.outstanding < w.slots]
+        if not free:
+            return None
+        worker = min(free, key=lambda w: w.outstanding / w.slots)
+        worker.outstanding += 1
+        return worker
+
+    def give(self, worker):
+        worker.outstanding -= 1
+
+
+def readfiles(cwd, names):
+    files = {}
+    for name in names:
+        with (cwd / name).open('r') as f:
+            files[name] = f.read()
+    return files
+
+
+def parse_worker_args(args=None) -> argparse.Namespace:
+    """ populate the pmpm-worker command line arguments
+
+    Args:
+        args: the arguments to parse
+
+    Returns:
+        parsed_args: the parsed arguments
+
+    """
+    parser = argparse.ArgumentParser(
+        description=("pmpm-worker: runs pandoc calls "
+                     "for a pmpm-websocket on another host"))
+    parser.add_argument(
+        "-l",
+        "--listen",
+        default=os.environ.get("PMPM_DEFAULT_LISTEN", "127.0.0.1:9879"),
+        help="host:port to listen on for pmpm-websocket connections",
+    )
+    parser.add_argument(
+        "--max-pandoc",
+        type=positive_int,
+        default=os.environ.get("PMPM_DEFAULT_MAX_PANDOC",
+                               os.cpu_count() or 1),
+        help="maximum number of concurrently running pandoc processes",
+    )
+    return parser.parse_args(args=args)
+
+
+class Worker:
+
+    def __init__(self, max_pandoc):
+        self._slots = max_pandoc
+        self._pool = PandocPool(max_pandoc)
+        self._calls = {}
+
+    def check(self):
+        """ set up the pandoc calls and convert a short markdown string
+
+        Raises:
+            OSError, subprocess.SubprocessError: if pandoc does not work
+        """
+        for math in ("mathml", "katex"):
+            self._calls[math] = pandoc_calls(math)
+        subprocess.run(self._calls["mathml"]["md2json"],
+                       input="pmpm",
+                       stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL,
+                       universal_newlines=True,
+                       timeout=JOB_TIMEOUT,
+                       check=True)
+
+    async def serve(self, reader, writer):
+        try:
+            while True:
+                message = await readmessage(reader)
+                if message.get('ping'):
+                    writemessage(writer, {"id": message['id'],
+                                          "slots": self._slots})
+                else:
+                    asyncio.ensure_future(self._job(writer, message))
+        except (OSError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def _call(self, message):
+        math = message['math']
+        if math not in ("mathml", "katex"):
+            raise ValueError(f"invalid math mode {math}")
+        if math not in self._calls:
+            self._calls[math] = pandoc_calls(math)
+        options = message['options']
+        for k in range(0, len(options), 2):
+            if (options[k] not in ("--to", "--slide-level")
+                    or not optionRegex.fullmatch(options[k+1])):
+                raise ValueError(f"invalid options {options}")
+        return self._calls[math][message['call']] + tuple(options)
+
+    async def _run(self, message):
+        cmd = self._call(message)
+        cwd = message['cwd']
+        if cwd is not None and Path(cwd).is_dir():
+            return await self._pool.run(cmd, message['stdin'], cwd)
+        with tempfile.TemporaryDirectory(prefix="pmpm-worker-") as d:
+            for name, content in message['files'].items():
+                fpath = (Path(d) / name).resolve()
+                if Path(d).resolve() not in fpath.parents:
+                    raise ValueError(f"invalid file name {name}")
+                fpath.parent.mkdir(parents=True, exist_ok=True)
+                fpath.write_text(content)
+            return await self._pool.run(cmd, message['stdin'], d)
+
+    async def _job(self, writer, message):
+        response = {"id": message.get('id')}
+        try:
+            response['stdout'] = await asyncio.wait_for(self._run(message),
+                                                        JOB_TIMEOUT)
+        except asyncio.TimeoutError:
+            response['error'] = f"timeout after {JOB_TIMEOUT}s"
+        # always answer, an unanswered call would hang its pmpm-websocket
+        except Exception as e:
+            response['error'] = str(e) or type(e).__name__
+        try:
+            writemessage(writer, response)
+        except (OSError, RuntimeError):
+            pass
+
+
+def run_worker():
+    """ start and run a pmpm-worker """
+    args = parse_worker_args()
+    host, port = args.listen.rsplit(':', 1)
+    worker = Worker(args.max_pandoc)
+    # without a working pandoc the worker would answer pings and fail every
+    # call, so that pmpm-websocket keeps sending it calls
+    try:
+        worker.check()
+    except (OSError, subprocess.SubprocessError) as e:
+        print(f"pmpm-worker: pandoc does not work: {e}", file=sys.stderr)
+        return 1
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(asyncio.start_server(worker.serve, host, port))
+    print(f"pmpm-worker started ({args.listen}, "
+          f"{args.max_pandoc} concurrent pandoc calls)")
+    loop.run_forever()
+
+
+if __name__ == "__main__":
+    exit(run_worker())
@@ -27,8 +27,10 @@ if __name__ == "__main__":
         license="GPLv3",
         entry_points={"console_scripts": [
             "pmpm = pmpm.pmpm:main",
-            "pmpm-websocket = pmpm.websocket:run_websocket_server"]},
-        python_requires=">=3.6",
+            "pmpm-websocket = pmpm.websocket:run_websocket_server",
+            "pmpm-loadtest = pmpm.loadtest:run_loadtest",
+            "pmpm-worker = pmpm.workers:run_worker"]},
+        python_requires=">=3.7",
         install_requires=install_requires,
         classifiers=[
             "Topic :: Utilities",